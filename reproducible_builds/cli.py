@@ -49,14 +49,23 @@ def download_stats():
 
 @cli.command()
 @click.option("--top", type=int, default=100)
-def download_top_projects(top):
+@click.option("--jobs", type=int, default=16, help="Number of concurrent downloads")
+@click.option("--pipeline", is_flag=True, help="Repack the packages while the remaining ones are still downloading")
+@click.option(
+    "--repack-jobs", type=int, default=None,
+    help="Number of packages repacked in parallel with `--pipeline`, defaults to the CPU count"
+)
+def download_top_projects(top, jobs, pipeline, repack_jobs):
     """
     Download the top K python packages based on download stats
     """
     if not (CWD/"pypi_download_stats.json").exists():
         download_stats()
 
-    downloader.download_top_projects(DEFAULT_OUT_DIR, top_k=top)
+    if pipeline:
+        repacker.repack_pipeline(downloader.stream_top_projects(DEFAULT_OUT_DIR, top_k=top, jobs=jobs), jobs=repack_jobs)
+    else:
+        downloader.download_top_projects(DEFAULT_OUT_DIR, top_k=top, jobs=jobs)
 
 
 @cli.command()
@@ -64,7 +73,7 @@ def build_docker_environment():
     """
     Build docker images from the template, needed for repacking wheels
     """
-    docker_environment.build_images()
+    docker_environment.build_images(log_dir=CWD / "docker_build_logs")
 
 
 @cli.command()
@@ -84,11 +93,16 @@ def repack(filename):
 
 
 @cli.command()
-def repack_all():
+@click.option("--jobs", type=int, default=None, help="Number of packages repacked in parallel, defaults to the CPU count")
+@click.option(
+    "--reuse-containers", is_flag=True,
+    help="Build all packages inside long-lived containers (one per environment) instead of a fresh container per package"
+)
+def repack_all(jobs, reuse_containers):
     """
     Automatically scan the target dataset dir and repack all packages within it
     """
-    repacker.repack_all(DEFAULT_OUT_DIR)
+    repacker.repack_all(DEFAULT_OUT_DIR, jobs=jobs, reuse_containers=reuse_containers)
 
 
 if __name__ == "__main__":
@@ -1,9 +1,18 @@
 from __future__ import annotations
 
-import json
+import os
+import sys
+import mmap
+import gzip
+import hashlib
+import shutil
 import subprocess
+import threading
+import multiprocessing
+import importlib.util
 import logging
 import enum
+import functools
 import tarfile
 import zipfile
 import tempfile
@@ -12,6 +21,35 @@ from contextlib import contextmanager
 from pathlib import Path
 import typing as t
 
+from .utils import json_loads
+
+try:
+    from isal import igzip
+except ImportError:
+    igzip = None
+
+try:
+    import libarchive
+    # Unrelated `libarchive` distribution shares the same module name
+    if not hasattr(libarchive, "file_reader"):
+        libarchive = None
+except (ImportError, OSError, AttributeError):
+    # libarchive-c fails with OSError/AttributeError when the libarchive shared library can't be loaded
+    libarchive = None
+
+
+# Normalized archives are only intermediate files for the diffs, compression speed matters more than the size
+GZIP_COMPRESSLEVEL = 1
+ZIP_COMPRESSLEVEL = 1
+COPY_BUFSIZE = 1 << 20
+# Threads used by each `pigz` process, kept small as the repack workers (and their diffs) are already running in parallel
+PIGZ_THREADS = 2
+# Hash used for the package checksums, sha256 is hardware accelerated on most of the current CPUs
+CHECKSUM_ALGORITHM = "sha256"
+# Size of the member contents kept in memory (rather than in a temporary file) when normalizing tar archives
+TAR_SPOOL_MAX_SIZE = 64 << 20
+# Run diffoscope through its python API instead of spawning the CLI when it is installed in the same environment
+HAS_DIFFOSCOPE_MODULE = importlib.util.find_spec("diffoscope") is not None
 
 logger = logging.getLogger(__name__)
 
@@ -22,20 +60,35 @@ class PackageType(enum.Enum):
     WHEEL = "wheel"
 
     @staticmethod
+    @functools.lru_cache(maxsize=4096)
     def detect(filename: str) -> t.Optional[PackageType]:
-        if filename.endswith(".whl"):
-            return PackageType.WHEEL
-        elif filename.endswith(".tar.gz"):
-            return PackageType.SDIST
-        else:
-            return None
+        for suffix, pkg_type in _SFX:
+            if filename.endswith(suffix):
+                return pkg_type
+
+        return None
+
+
+# Filename suffixes of the supported package types, checked in order by `PackageType.detect`
+_SFX = (
+    (".whl", PackageType.WHEEL),
+    # `.tgz` sdists are not included, `python -m build` would always repack them under a `.tar.gz` name
+    (".tar.gz", PackageType.SDIST),
+)
 
 
 @dataclasses.dataclass
 class Package:
+    # `dataclass(slots=True)` is not available on python 3.9
+    __slots__ = ("package_type", "path", "_is_wheel", "_repack_dir")
+
     package_type: PackageType
     path: Path
 
+    def __post_init__(self):
+        self._is_wheel = (self.package_type is PackageType.WHEEL)
+        self._repack_dir: t.Optional[Path] = None
+
     @classmethod
     def from_file(cls, path: Path) -> Package:
         if not (pkg_type:=PackageType.detect(path.name)):
@@ -47,73 +100,109 @@ class Package:
         )
 
     @classmethod
-    def enumerate(cls, location: Path):
-        for pypi_stats in location.glob("*/pypi_metadata.json"):
-            metadata = json.loads(pypi_stats.read_text())
+    def enumerate(cls, location: Path) -> t.Iterator[Package]:
+        if not location.is_dir():
+            return
+
+        # `os.scandir` provides the file type from the directory listing itself, avoiding a `stat` call per file
+        with os.scandir(location) as projects:
+            for project in projects:
+                if not project.is_dir():
+                    continue
 
-            for version, releases in metadata["releases"].items():
-                version_path = pypi_stats.parent / version
-                if not version_path.exists():
+                project_path = Path(project.path)
+                try:
+                    metadata = json_loads((project_path / "pypi_metadata.json").read_bytes())
+                except FileNotFoundError:
                     continue
 
-                for release in releases:
-                    pkg_path = version_path / release["filename"]
-                    if not pkg_path.is_file():
-                        continue
-                    elif not (pkg_type:=PackageType.detect(release["filename"])):
+                all_releases = metadata["releases"]
+                # Only a few versions are usually downloaded, look up just those instead of walking all the releases
+                with os.scandir(project_path) as versions:
+                    version_dirs = [entry for entry in versions if entry.is_dir()]
+
+                for version_dir in version_dirs:
+                    if (releases:=all_releases.get(version_dir.name)) is None:
                         continue
-                    yield cls(
-                        package_type=pkg_type,
-                        path = pkg_path
-                    )
+
+                    version_path = Path(version_dir.path)
+                    with os.scandir(version_path) as version_entries:
+                        files = {entry.name for entry in version_entries if entry.is_file()}
+
+                    for release in releases:
+                        if release["filename"] not in files:
+                            continue
+                        elif not (pkg_type:=PackageType.detect(release["filename"])):
+                            continue
+                        yield cls(
+                            package_type=pkg_type,
+                            path = version_path / release["filename"]
+                        )
 
     @property
     def repack_dir(self) -> Path:
-        name = self.path.name.replace(".", "_") + "_repacked"
-        return (self.path.parent / name).absolute()
+        if self._repack_dir is None:
+            name = self.path.name.replace(".", "_") + "_repacked"
+            self._repack_dir = (self.path.parent / name).absolute()
+        return self._repack_dir
 
     def find_sdist(self) -> t.Optional[Package]:
         location = self.path.parent
 
-        for pkg in location.glob("*"):
-            pkg_type = PackageType.detect(pkg.name)
+        with os.scandir(location) as entries:
+            for entry in entries:
+                pkg_type = PackageType.detect(entry.name)
 
-            if pkg_type == PackageType.SDIST:
-                return Package(package_type=pkg_type, path=pkg)
+                if pkg_type == PackageType.SDIST:
+                    return Package(package_type=pkg_type, path=location / entry.name)
 
-    def normalize(self, dest: Path):
-        if self.path.name.endswith(".whl"):
-            src_arch = zipfile.ZipFile(self.path.absolute(), "r")
-            dest_arch = zipfile.ZipFile(dest, "w")
-            normalize_zip(in_zip=src_arch, out_zip=dest_arch)
-            dest_arch.close()
-        else:
-            src_arch = tarfile.open(self.path.absolute(), "r:*")
-            dest_arch = tarfile.open(dest, "w:gz")
-            normalize_tar(in_tar=src_arch, out_tar=dest_arch)
-            dest_arch.close()
+    def normalize(self, dest: Path, hasher=None) -> str:
+        # Returns the hex digest of the normalized archive, computed by the `hasher` while writing it
+        if hasher is None:
+            hasher = hashlib.new(CHECKSUM_ALGORITHM)
+
+        with MappedFile(self.path.absolute()) as src_fd:
+            if self._is_wheel:
+                with zipfile.ZipFile(src_fd, "r") as src_arch, zipfile.ZipFile(dest, "w") as dest_arch:
+                    normalize_zip(in_zip=src_arch, out_zip=dest_arch)
+                # ZipFile seeks back to patch the local headers, the content can be hashed only once it's complete
+                hash_file(dest, hasher)
+            else:
+                with tarfile.open(fileobj=src_fd, mode="r|*") as src_arch, \
+                        gzip_writer(dest, hasher=hasher) as gz_fd, \
+                        tarfile.open(
+                            fileobj=gz_fd,
+                            mode="w|",
+                            format=tarfile.PAX_FORMAT,
+                            copybufsize=COPY_BUFSIZE
+                        ) as dest_arch:
+                    normalize_tar(in_tar=src_arch, out_tar=dest_arch)
+
+        return hasher.hexdigest()
 
     @contextmanager
-    def as_source(self):
-        with tempfile.TemporaryDirectory(prefix="reproducible_src_dir_") as tmpdir:
+    def as_source(self, tmp_root: t.Optional[Path]=None):
+        with tempfile.TemporaryDirectory(prefix="reproducible_src_dir_", dir=tmp_root) as tmpdir:
             logger.info(f"Created temporary directory for sources: `{tmpdir}`")
             tmp_path = Path(tmpdir)
 
-            if self.path.name.endswith(".tar.gz"):
-                with tarfile.open(self.path, "r:*") as archive:
-                    logger.info(f"Extracting `{self.path.name}` to `{tmpdir}`")
-                    archive.extractall(tmpdir)
-
-                    for x in tmp_path.glob("*/PKG-INFO"):
-                        yield x.parent
-                        break
-            elif self.path.name.endswith(".whl"):
-                archive = zipfile.ZipFile(self.path, "r")
+            if not self._is_wheel:
                 logger.info(f"Extracting `{self.path.name}` to `{tmpdir}`")
-                archive.extractall(tmpdir)
-                yield tmpdir
+                if libarchive is not None:
+                    extract_libarchive(self.path, tmp_path)
+                else:
+                    with gzip_reader(self.path) as gz_fd, tarfile.open(fileobj=gz_fd, mode="r|") as archive:
+                        extract_tar(archive, tmp_path)
+
+                for x in tmp_path.glob("*/PKG-INFO"):
+                    yield x.parent
+                    break
             else:
-                raise ValueError("Unknown archive format for this file")
+                with MappedFile(self.path) as src_fd:
+                    archive = zipfile.ZipFile(src_fd, "r")
+                    logger.info(f"Extracting `{self.path.name}` to `{tmpdir}`")
+                    extract_zip(archive, tmp_path)
+                yield tmpdir
 
     def __str__(self):
         return self.path.name
@@ -188,41 +277,286 @@ def diffoscope(original: Path, modified: Path, target_path: t.Optional[Path]=Non
     stdout = target_path / f"diffoscope_stderr{suffix}.txt"
     stderr = target_path / f"diffoscope_stdout{suffix}.txt"
 
-    with open(stdout, "w") as stdout_fd, open(stderr, "w") as stderr_fd:
-        out_p = subprocess.run(cmd, stdout=stdout_fd, stderr=stderr_fd)
+    return _exec_diffoscope(cmd, stdout=stdout, stderr=stderr).returncode
 
-    return out_p.returncode
 
 
 
 
+# Read-only file object backed by a memory map of the whole file, random access reads (such as the zip
+# central directory lookups) are served from the page cache without issuing a read syscall for each of them
+class MappedFile:
+    def __init__(self, path: Path):
+        self.name = str(path)
+        self.mode = "rb"
 
-def normalize_tar(in_tar: tarfile.TarFile, out_tar: tarfile.TarFile):
-    members = list(in_tar.getmembers())
-    members.sort(key=lambda x: x.name)
+        with path.open("rb") as fd:
+            self._mmap = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
 
-    for member in members:
-        new_member = tarfile.TarInfo(name=member.name)
-        new_member.uid = 0
-        new_member.gid = 0
-        new_member.mtime = 0
-        new_member.uname = ""
-        new_member.gname = ""
-        new_member.type = member.type
-        new_member.size = member.size
-
-        if member.isfile():
-            with in_tar.extractfile(member) as archive_file:
-                out_tar.addfile(new_member, archive_file)
-        elif new_member.isdir():
-            out_tar.addfile(new_member)
+        self.read = self._mmap.read
+        self.tell = self._mmap.tell
+
+    def seek(self, offset: int, whence: int=os.SEEK_SET) -> int:
+        self._mmap.seek(offset, whence)
+        return self._mmap.tell()
+
+    def readinto(self, buffer) -> int:
+        data = self._mmap.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def seekable(self) -> bool:
+        return True
+
+    def readable(self) -> bool:
+        return True
+
+    def close(self):
+        self._mmap.close()
+
+    def __enter__(self) -> MappedFile:
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class HashingWriter:
+    # Passes the written data through to the underlying file object while also updating the hasher with it
+    def __init__(self, inner: t.BinaryIO, hasher):
+        self.inner = inner
+        self.hasher = hasher
+        self.name = inner.name
+
+    def write(self, data) -> int:
+        self.hasher.update(data)
+        return self.inner.write(data)
+
+    def flush(self):
+        self.inner.flush()
+
+
+def hash_file(pth: Path, hasher):
+    with pth.open("rb") as fd:
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(fd, lambda: hasher)
+
+        # Python < 3.11
+        while chunk := fd.read(COPY_BUFSIZE):
+            hasher.update(chunk)
+        return hasher
+
+
+@contextmanager
+def gzip_writer(dest: Path, hasher=None) -> t.Iterator[t.BinaryIO]:
+    # Compressed output is also fed to the `hasher` as it is written if provided
+    with dest.open("wb") as out_fd:
+        if hasher is not None:
+            out_fd = HashingWriter(out_fd, hasher)
+
+        # Compression is offloaded to `pigz` if it's available, otherwise ISA-L (`isal`) is preferred over zlib.
+        # None of them stores the file name in the header, but the output (and so the digest) still depends on the backend
+        if (pigz:=shutil.which("pigz")) is None:
+            # Empty `filename` omits the file name from the header (it would be taken from `out_fd`), same as `pigz -n`
+            with (igzip or gzip).GzipFile(
+                    filename="", fileobj=out_fd, mode="wb", compresslevel=GZIP_COMPRESSLEVEL, mtime=0
+            ) as gz_fd:
+                yield gz_fd
+            return
+
+        # `-n` omits the file name and timestamp from the gzip header
+        proc = subprocess.Popen(
+            [pigz, "-c", "-n", "-p", str(PIGZ_THREADS), f"-{GZIP_COMPRESSLEVEL}"],
+            stdin=subprocess.PIPE,
+            stdout=(subprocess.PIPE if hasher is not None else out_fd)
+        )
+        copy_errors = []
+        if hasher is not None:
+            copier = threading.Thread(target=_copy_pipe, args=(proc.stdout, out_fd, copy_errors))
+            copier.start()
+
+        try:
+            try:
+                yield proc.stdin
+            finally:
+                try:
+                    proc.stdin.close()
+                finally:
+                    if hasher is not None:
+                        copier.join()
+                        proc.stdout.close()
+                    proc.wait()
+        except BrokenPipeError:
+            # pigz was terminated because copying of its output has failed, report the original error instead
+            if copy_errors:
+                raise copy_errors[0]
+            raise
+
+        if copy_errors:
+            raise copy_errors[0]
+
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+
+def _copy_pipe(src: t.BinaryIO, dst: t.BinaryIO, errors: t.List[BaseException]):
+    try:
+        shutil.copyfileobj(src, dst, COPY_BUFSIZE)
+    except BaseException as exc:
+        errors.append(exc)
+        # Closing the read end makes the writing process fail (EPIPE) instead of blocking on a full pipe forever
+        src.close()
+
+
+@contextmanager
+def gzip_reader(src: Path) -> t.Iterator[t.BinaryIO]:
+    # Decompression is offloaded to a separate `pigz` process if it's available
+    if (pigz:=shutil.which("pigz")) is None:
+        with MappedFile(src) as src_fd, (igzip or gzip).GzipFile(fileobj=src_fd, mode="rb") as gz_fd:
+            yield gz_fd
+        return
+
+    proc = subprocess.Popen([pigz, "-d", "-c", "-p", str(PIGZ_THREADS), str(src)], stdout=subprocess.PIPE)
+    try:
+        yield proc.stdout
+        # Drain the trailing data so pigz can finish and verify the checksum
+        while proc.stdout.read(COPY_BUFSIZE):
+            pass
+    finally:
+        proc.stdout.close()
+        proc.wait()
+
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+
+def extract_tar(archive: tarfile.TarFile, dest: Path):
+    # Works also for archives opened in the stream mode, members must be processed in the order they are stored
+    buffer = bytearray(COPY_BUFSIZE)
+    directories = []
+
+    for member in archive:
+        target = _extraction_target(dest, member.name)
+
+        if member.isreg():
+            target.parent.mkdir(parents=True, exist_ok=True)
+            with archive.extractfile(member) as src_fd, target.open("wb") as dst_fd:
+                _copy_with_buffer(src_fd, dst_fd, buffer)
+            os.chmod(target, member.mode)
+            os.utime(target, (member.mtime, member.mtime))
+        elif member.isdir():
+            target.mkdir(parents=True, exist_ok=True)
+            directories.append((member, target))
         else:
-            out_tar.addfile(member)
+            archive.extract(member, dest)
+
+    # Attributes of the directories are set only after their content has been extracted, same as `extractall`
+    for member, target in reversed(directories):
+        os.chmod(target, member.mode)
+        os.utime(target, (member.mtime, member.mtime))
+
+
+def extract_libarchive(src: Path, dest: Path):
+    # Same as `extract_tar` but the archive is decompressed and parsed by libarchive (C) instead of the tarfile
+    directories = []
+
+    with libarchive.file_reader(str(src)) as archive:
+        for entry in archive:
+            target = _extraction_target(dest, entry.pathname)
+
+            if entry.isreg:
+                target.parent.mkdir(parents=True, exist_ok=True)
+                with target.open("wb") as dst_fd:
+                    for block in entry.get_blocks(COPY_BUFSIZE):
+                        dst_fd.write(block)
+                os.chmod(target, entry.perm)
+                os.utime(target, (entry.mtime, entry.mtime))
+            elif entry.isdir:
+                target.mkdir(parents=True, exist_ok=True)
+                directories.append((entry.perm, entry.mtime, target))
+            elif entry.issym:
+                target.parent.mkdir(parents=True, exist_ok=True)
+                os.symlink(entry.linkpath, target)
+            elif entry.islnk:
+                target.parent.mkdir(parents=True, exist_ok=True)
+                os.link(_extraction_target(dest, entry.linkpath), target)
+            else:
+                logger.warning(f"Skipping extraction of the special file `{entry.pathname}` from `{src.name}`")
+
+    for perm, mtime, target in reversed(directories):
+        os.chmod(target, perm)
+        os.utime(target, (mtime, mtime))
+
+
+def extract_zip(archive: zipfile.ZipFile, dest: Path):
+    buffer = bytearray(COPY_BUFSIZE)
+
+    for member in archive.infolist():
+        target = _extraction_target(dest, member.filename)
+
+        if member.is_dir():
+            target.mkdir(parents=True, exist_ok=True)
+            continue
+
+        target.parent.mkdir(parents=True, exist_ok=True)
+        with archive.open(member) as src_fd, target.open("wb") as dst_fd:
+            _copy_with_buffer(src_fd, dst_fd, buffer)
+
+
+def _extraction_target(dest: Path, name: str) -> Path:
+    if os.path.isabs(name) or ".." in Path(name).parts:
+        raise ValueError(f"Archive member `{name}` would be extracted outside of `{dest}`")
+    return dest / name
+
+
+def _copy_with_buffer(src_fd: t.BinaryIO, dst_fd: t.BinaryIO, buffer: bytearray):
+    view = memoryview(buffer)
+    while (size := src_fd.readinto(view)):
+        dst_fd.write(view[:size])
+
+
+def normalize_tar(in_tar: tarfile.TarFile, out_tar: tarfile.TarFile):
+    # Reading the members out of order from a compressed archive makes every backwards seek decompress it again from
+    # the start, the archive is instead read in a single pass with the file contents spooled aside at known offsets
+    buffer = bytearray(COPY_BUFSIZE)
+
+    with tempfile.SpooledTemporaryFile(max_size=TAR_SPOOL_MAX_SIZE, prefix="reproducible_tar_spool_") as spool:
+        members = []
+
+        for member in in_tar:
+            offset = None
+            if member.isfile():
+                offset = spool.tell()
+                with in_tar.extractfile(member) as archive_file:
+                    _copy_with_buffer(archive_file, spool, buffer)
+
+            members.append((member, offset))
+
+        members.sort(key=lambda x: x[0].name)
+
+        for member, offset in members:
+            new_member = tarfile.TarInfo(name=member.name)
+            new_member.uid = 0
+            new_member.gid = 0
+            new_member.mtime = 0
+            new_member.uname = ""
+            new_member.gname = ""
+            new_member.type = member.type
+            new_member.size = member.size
+
+            if member.isfile():
+                spool.seek(offset)
+                out_tar.addfile(new_member, spool)
+            elif new_member.isdir():
+                out_tar.addfile(new_member)
+            else:
+                out_tar.addfile(member)
 
 
 def normalize_zip(in_zip: zipfile.ZipFile, out_zip: zipfile.ZipFile):
     members = list(in_zip.infolist())
     members.sort(key=lambda x: x.filename)
+    buffer = bytearray(COPY_BUFSIZE)
 
     for member in members:
         new_member = zipfile.ZipInfo(
@@ -231,8 +565,17 @@ def normalize_zip(in_zip: zipfile.ZipFile, out_zip: zipfile.ZipFile):
         )
         new_member.external_attr = 0o770 << 16
         new_member.compress_type = member.compress_type
-        data = in_zip.read(name=member.filename)
-        out_zip.writestr(new_member, data=data)
+        # Same as `writestr(..., compresslevel=)`, which is not available when writing through `ZipFile.open`
+        if hasattr(new_member, "compress_level"):  # Python 3.13+
+            new_member.compress_level = ZIP_COMPRESSLEVEL
+        else:
+            new_member._compresslevel = ZIP_COMPRESSLEVEL
+        # Known upfront so the zip64 decision is the same as in `ZipFile.writestr`
+        new_member.file_size = member.file_size
+
+        # Members are streamed instead of being read whole into memory, the output is the same as with `writestr`
+        with in_zip.open(member, "r") as src, out_zip.open(new_member, "w") as dst:
+            _copy_with_buffer(src, dst, buffer)
 
 
 def run_diffoscope(original: Path, target: Path, suffix="", out_dir: t.Optional[Path]=None) -> subprocess.CompletedProcess:
@@ -255,7 +598,32 @@ def run_diffoscope(original: Path, target: Path, suffix="", out_dir: t.Optional[
     stdout: Path = out_dir / f"diff{suffix}.stdout.txt"
     stderr: Path = out_dir / f"diff{suffix}.stderr.txt"
 
-    with stdout.open("w") as stdout_fd, stderr.open("w") as stderr_fd:
-        out_p = subprocess.run(cmd, stdout=stdout_fd, stderr=stderr_fd)
+    return _exec_diffoscope(cmd, stdout=stdout, stderr=stderr)
+
 
-    return out_p
+def _exec_diffoscope(cmd: t.List[str], stdout: Path, stderr: Path) -> subprocess.CompletedProcess:
+    if not HAS_DIFFOSCOPE_MODULE:
+        with stdout.open("w") as stdout_fd, stderr.open("w") as stderr_fd:
+            return subprocess.run(cmd, stdout=stdout_fd, stderr=stderr_fd)
+
+    # Diffoscope is not safe to be called repeatedly within the same interpreter (global state, signal handlers...)
+    # so each diff still runs in its own process but forked from a server that has it already imported
+    # which avoids paying for the interpreter startup and the plugin discovery on every call
+    ctx = multiprocessing.get_context("forkserver")
+    ctx.set_forkserver_preload(["diffoscope.main"])
+    proc = ctx.Process(target=_diffoscope_worker, args=(cmd[1:], str(stdout), str(stderr)))
+    proc.start()
+    proc.join()
+    return subprocess.CompletedProcess(args=cmd, returncode=proc.exitcode)
+
+
+def _diffoscope_worker(args: t.List[str], stdout: str, stderr: str):
+    with open(stdout, "w") as stdout_fd, open(stderr, "w") as stderr_fd:
+        os.dup2(stdout_fd.fileno(), 1)
+        os.dup2(stderr_fd.fileno(), 2)
+        sys.stdout = stdout_fd
+        sys.stderr = stderr_fd
+
+        from diffoscope.main import main
+        # main() terminates via sys.exit, its exit code is propagated as the exit code of the process
+        main(args)
@@ -1,7 +1,7 @@
 from pathlib import Path
 
 
-DATA_LOCATION = Path(__file__).parent.absolute().relative_to(Path.cwd())
+DATA_LOCATION = Path(__file__).resolve().parent
 
 
 def get_file(name: str) -> Path:
@@ -1,13 +1,24 @@
 import sys
 import os
+import logging
+import functools
+import tempfile
 import subprocess
+import dataclasses
 from pathlib import Path
-from contextlib import nullcontext
+from contextlib import contextmanager, nullcontext, ExitStack
 import typing as t
 
 from packaging.utils import parse_wheel_filename
 
 from .data import get_file
+from .common import PackageType
+
+
+SOURCE_DIR = "/source_dir"
+OUTPUT_DIR = "/output_dir"
+
+logger = logging.getLogger(__name__)
 
 
 docker_tags = {
@@ -20,26 +31,108 @@ docker_tags = {
 
 
 
-def build_images():
+def build_images(log_dir: t.Optional[Path]=None):
     docker_file = get_file("Dockerfile_buildenv")
-    cwd = os.getcwd()
+    env = dict(os.environ, DOCKER_BUILDKIT="1")
+    builds = []
 
-    try:
-        os.chdir(docker_file.parent)
+    if log_dir is not None:
+        log_dir.mkdir(exist_ok=True, parents=True)
 
+    with ExitStack() as stack:
         for py_version, base_image in docker_tags.items():
-            image_tag = f"reproducible_env:py{py_version[0]}.{py_version[1]}"
-
             cmd = [
                 "docker", "build",
-                "-t", image_tag,
+                "--progress=plain",
+                "-t", image_tag(py_version),
                 "--build-arg", f"BASE_IMAGE={base_image}",
                 "-f", str(docker_file.name),
                 "."
             ]
-            subprocess.check_call(cmd, stderr=sys.stderr, stdout=sys.stdout)
-    finally:
-        os.chdir(cwd)
+
+            if log_dir is not None:
+                log_name = f"docker_build.py{py_version[0]}.{py_version[1]}"
+                stdout_fd = stack.enter_context((log_dir / f"{log_name}.stdout.txt").open("w"))
+                stderr_fd = stack.enter_context((log_dir / f"{log_name}.stderr.txt").open("w"))
+            else:
+                stdout_fd, stderr_fd = sys.stdout, sys.stderr
+
+            logger.info(f"Building docker image `{image_tag(py_version)}`")
+            proc = subprocess.Popen(cmd, cwd=docker_file.parent, env=env, stdout=stdout_fd, stderr=stderr_fd)
+            builds.append((cmd, proc))
+
+        for _, proc in builds:
+            proc.wait()
+
+    for cmd, proc in builds:
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+
+@dataclasses.dataclass(frozen=True)
+class PersistentContainers:
+    # Maps the docker environment to a name of the long-lived container running it
+    containers: t.Dict[t.Tuple[int, int], str]
+    # Directories bind mounted into every container under the same path as on the host
+    source_root: Path
+    output_root: Path
+
+    def covers(self, path: Path) -> bool:
+        path = path.absolute()
+        return any(path == root or root in path.parents for root in (self.source_root, self.output_root))
+
+
+_persistent: t.Optional[PersistentContainers] = None
+
+
+@contextmanager
+def persistent_containers(output_root: Path) -> t.Iterator[PersistentContainers]:
+    # Start a long-lived container for each docker environment, builds are then dispatched into them
+    # via `docker exec` instead of paying the container startup for every package
+    output_root = output_root.absolute()
+    containers = {}
+
+    with tempfile.TemporaryDirectory(prefix="reproducible_shared_src_") as source_root:
+        source_root = Path(source_root)
+
+        try:
+            for docker_env in docker_tags:
+                name = f"reproducible_env_py{docker_env[0]}.{docker_env[1]}_{os.getpid()}"
+                cmd = [
+                    "docker", "run", "-d", "--rm",
+                    "--name", name,
+                    "-v", f"{source_root}:{source_root}",
+                    "-v", f"{output_root}:{output_root}",
+                    image_tag(docker_env),
+                    "sleep", "infinity"
+                ]
+
+                if subprocess.run(cmd, stdout=subprocess.DEVNULL).returncode != 0:
+                    logger.warning(f"Could not start a persistent container for `{image_tag(docker_env)}`")
+                    continue
+
+                containers[docker_env] = name
+
+            yield PersistentContainers(containers=containers, source_root=source_root, output_root=output_root)
+        finally:
+            if containers:
+                subprocess.run(["docker", "rm", "-f", *containers.values()], stdout=subprocess.DEVNULL)
+
+
+def use_persistent_containers(persistent: t.Optional[PersistentContainers]):
+    global _persistent
+    _persistent = persistent
+
+
+def shared_source_root() -> t.Optional[Path]:
+    # Sources must be placed in this directory to be built inside the persistent containers
+    if _persistent is None:
+        return None
+    return _persistent.source_root
+
+
+def image_tag(docker_env: t.Tuple[int, int]) -> str:
+    return f"reproducible_env:py{'.'.join(map(str, docker_env))}"
 
 
 def run_in_docker(
@@ -50,18 +143,28 @@ def run_in_docker(
         stdout: t.Optional[Path]=None,
         stderr: t.Optional[Path]=None
 ) -> subprocess.CompletedProcess:
-    docker_tag = f"reproducible_env:py{'.'.join(map(str, docker_env))}"
-
-    final_cmd = [
-        "docker", "run", "--rm",
-        # Add source dir volume mount
-        "-v", f"{str(source_dir.absolute())}:/source_dir",
-        # Mount output dir volume
-        "-v", f"{str(output_dir)}:/output_dir",
-        "-w", "/source_dir",
-        docker_tag,
-        *cmd
-    ]
+    container = _persistent.containers.get(docker_env) if _persistent is not None else None
+
+    if container and _persistent.covers(source_dir) and _persistent.covers(output_dir):
+        # Directories are mounted under their host paths in the persistent containers
+        mapping = {SOURCE_DIR: str(source_dir.absolute()), OUTPUT_DIR: str(output_dir.absolute())}
+        final_cmd = [
+            "docker", "exec",
+            "-w", mapping[SOURCE_DIR],
+            container,
+            *(_map_path(arg, mapping) for arg in cmd)
+        ]
+    else:
+        final_cmd = [
+            "docker", "run", "--rm",
+            # Add source dir volume mount
+            "-v", f"{str(source_dir.absolute())}:{SOURCE_DIR}",
+            # Mount output dir volume
+            "-v", f"{str(output_dir)}:{OUTPUT_DIR}",
+            "-w", SOURCE_DIR,
+            image_tag(docker_env),
+            *cmd
+        ]
 
     if stdout:
         stdout_cm = stdout.open("w")
@@ -77,9 +180,17 @@ def run_in_docker(
         return subprocess.run(final_cmd, stdout=stdout_fd, stderr=stderr_fd)
 
 
+def _map_path(arg: str, mapping: t.Dict[str, str]) -> str:
+    for container_path, host_path in mapping.items():
+        if arg == container_path or arg.startswith(container_path + "/"):
+            return host_path + arg[len(container_path):]
+    return arg
+
+
+@functools.lru_cache(maxsize=None)
 def get_environment_version(fname: str) -> t.Optional[t.Tuple[int, int]]:
     # Return latest python for sdist
-    if fname.endswith(".tar.gz"):
+    if PackageType.detect(fname) is PackageType.SDIST:
         return (3, 11)
 
     name, ver, build, tags = parse_wheel_filename(fname)
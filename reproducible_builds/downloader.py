@@ -1,49 +1,119 @@
-import json
+import os
+import shutil
 import logging
 from pathlib import Path
+import typing as t
+from itertools import islice
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+from .utils import json_loads
+
+
+DOWNLOAD_CHUNK_SIZE = 1 << 20
 
 logger = logging.getLogger(__name__)
 
 
-def download_project(name: str, out_dir: Path) -> bool:
-    json_resp = requests.get(f"https://pypi.org/pypi/{name}/json")
-    proj_json = json_resp.json()
+def create_session() -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=32,
+        pool_maxsize=32,
+        max_retries=Retry(total=3, backoff_factor=0.3)
+    )
+    session.mount("https://", adapter)
+    return session
+
+
+SESSION = create_session()
+
 
+def download_project(name: str, out_dir: Path) -> t.List[Path]:
     proj_root_dir = (out_dir / name)
-    proj_root_dir.mkdir(exist_ok=True, parents=True)
-    (proj_root_dir / "pypi_metadata.json").write_text(json_resp.text)
+    metadata_path = proj_root_dir / "pypi_metadata.json"
+    etag_path = proj_root_dir / "pypi_metadata.etag"
+
+    headers = {}
+    if metadata_path.exists() and etag_path.exists():
+        headers["If-None-Match"] = etag_path.read_text()
+
+    json_resp = SESSION.get(f"https://pypi.org/pypi/{name}/json", headers=headers, timeout=30)
+
+    if json_resp.status_code == 304:  # Metadata did not change since the last download
+        proj_json = json_loads(metadata_path.read_bytes())
+    else:
+        proj_json = json_loads(json_resp.content)
+        proj_root_dir.mkdir(exist_ok=True, parents=True)
+        metadata_path.write_bytes(json_resp.content)
+
+        if (etag:=json_resp.headers.get("ETag")):
+            etag_path.write_text(etag)
 
     proj_dir = proj_root_dir / proj_json["info"]["version"]
     proj_dir.mkdir(exist_ok=True)
+    packages = []
 
     for url in proj_json["urls"]:
         pkg_path = proj_dir/url["filename"]
 
         if pkg_path.exists() and pkg_path.stat().st_size == url["size"]:  # Already downloaded
+            packages.append(pkg_path)
             continue
 
         logger.info(f"Downloading `{url['url']}`")
-        pkg_resp = requests.get(url["url"])
+        with SESSION.get(url["url"], stream=True, timeout=30) as pkg_resp:
+            if pkg_resp.status_code != 200:
+                logger.warning(f"Error downloading `{url['url']}`: HTTP {pkg_resp.status_code}")
+                continue
 
-        if pkg_resp.status_code != 200:
-            logger.warning(f"Error downloading `{url['url']}`: HTTP {pkg_resp.status_code}")
-            continue
+            pkg_resp.raw.decode_content = True
+            # Written under a temporary name so an interrupted download is not picked up as a valid package
+            partial_path = pkg_path.with_name(pkg_path.name + ".part")
+            with partial_path.open("wb") as fd:
+                shutil.copyfileobj(pkg_resp.raw, fd, length=DOWNLOAD_CHUNK_SIZE)
 
-        pkg_path.write_bytes(pkg_resp.content)
+        os.replace(partial_path, pkg_path)
+        packages.append(pkg_path)
 
+    return packages
 
-def download_top_projects(out_dir: Path, top_k: int=100):
-    with open("pypi_download_stats.json", "r") as fd:
-        for idx, stat in enumerate(fd):
-            if idx >= top_k:
-                return
 
-            if not (stat:=stat.strip()):
+def top_projects(top_k: int=100) -> t.Iterator[str]:
+    with open("pypi_download_stats.json", "rb") as fd:
+        for idx, stat in enumerate(islice(fd, top_k)):
+            if stat.isspace():
                 continue
 
-            stat = json.loads(stat)
+            stat = json_loads(stat)
             logger.info(f"Processing package `{stat['package_name']}` #{idx+1}")
-            download_project(stat["package_name"], out_dir)
+            yield stat["package_name"]
+
+
+def download_top_projects(out_dir: Path, top_k: int=100, jobs: int=16):
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(download_project, name, out_dir) for name in top_projects(top_k)]
+
+        for future in futures:
+            future.result()
+
+
+def stream_top_projects(out_dir: Path, top_k: int=100, jobs: int=16) -> t.Iterator[Path]:
+    # Up to `jobs` projects are downloaded ahead, packages are still yielded in the order of the download stats
+    names = top_projects(top_k)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        window = deque(executor.submit(download_project, name, out_dir) for name in islice(names, jobs))
+        try:
+            while window:
+                packages = window.popleft().result()
+                for name in islice(names, 1):
+                    window.append(executor.submit(download_project, name, out_dir))
+
+                yield from packages
+        finally:
+            for future in window:
+                future.cancel()
@@ -1,8 +1,40 @@
-import json
 import typing as t
 
 
 from .common import ReproducibleResults
+from .utils import json_loads, json_dumps
+
+
+_REASONS = (
+    "archive_metadata",
+    "packaging_tools",
+    "timestamps",
+    "permissions",
+    "unknown",
+    "distribution_metadata",
+    "distribution_description",
+    "distribution_headers",
+)
+
+
+def _reasons_mask(*reasons: str) -> int:
+    mask = 0
+    for reason in reasons:
+        mask |= 1 << _REASONS.index(reason)
+    return mask
+
+
+# Aura diff tags and a bitmask of the reasons (indexes into `_REASONS`) they indicate
+_TAG_REASONS = (
+    ("non-reproducibility:tooling", _reasons_mask("packaging_tools")),
+    ("non-reproducibility:metadata:payload:normalization", _reasons_mask("distribution_metadata", "distribution_description")),
+    ("non-reproducibility:metadata:key-value", _reasons_mask("distribution_metadata", "distribution_headers")),
+    ("non-reproducibility:metadata", _reasons_mask("archive_metadata")),
+    ("non-reproducibility:zip:timestamp", _reasons_mask("timestamps")),
+    ("non-reproducibility:zip:external-attributes", _reasons_mask("permissions")),
+    ("non-reproducibility:metadata:payload:unknown", _reasons_mask("distribution_metadata")),
+    ("non-reproducibility:unknown", _reasons_mask("unknown")),
+)
 
 
 def combine_results(
@@ -26,32 +58,32 @@ def combine_results(
         "normalized_tags": None,
         "normalized_diffoscope": None,
         "normalized_aura_diff": None,
-        "package_metadata": json.loads((pkg_root / "pypi_metadata.json").read_text())
+        "package_metadata": json_loads((pkg_root / "pypi_metadata.json").read_bytes())
     }
 
     n_tags = None
     o_tags = None
 
     if (orig_diff:=results.original_diffoscope):
-        combined["original_diffoscope"] = json.loads(orig_diff.read_text())
+        combined["original_diffoscope"] = json_loads(orig_diff.read_bytes())
 
     if (orig_adiff:=results.aura_diff):
-        combined["original_aura_diff"] = json.loads(orig_adiff.read_text())
+        combined["original_aura_diff"] = json_loads(orig_adiff.read_bytes())
         o_tags = extract_tags(combined["original_aura_diff"])
         combined["original_tags"] = list(o_tags)
         combined["results"]["original"] = extract_reasons_from_tags(o_tags)
 
     if (norm_diff:=results.normalized_diffoscope):
-        combined["normalized_diffoscope"] = json.loads(norm_diff.read_text())
+        combined["normalized_diffoscope"] = json_loads(norm_diff.read_bytes())
 
     if (norm_adiff:=results.normalized_aura_diff):
-        combined["normalized_aura_diff"] = json.loads(norm_adiff.read_text())
+        combined["normalized_aura_diff"] = json_loads(norm_adiff.read_bytes())
         n_tags = extract_tags(combined["normalized_aura_diff"])
         combined["normalized_tags"] = list(n_tags)
         combined["results"]["normalized"] = extract_reasons_from_tags(n_tags)
 
-    if (md5s:=results.checksums):
-        combined["checksums"] = (checksums:=json.loads(md5s.read_text()))
+    if (checksums_pth:=results.checksums):
+        combined["checksums"] = (checksums:=json_loads(checksums_pth.read_bytes()))
 
         combined["results"]["reproducible"] = (checksums["original"] == checksums["repacked"])
         combined["results"]["normalized_reproducible"] = (checksums["normalized_original"] == checksums["normalized_repacked"])
@@ -65,49 +97,16 @@ def combine_results(
         combined["normalization_removed_tags"] = list(diff_tags)
         combined["results"]["normalization_effects"] = extract_reasons_from_tags(diff_tags)
 
-    with (results.data_dir / "reproducible_results.json").open("w") as fd:
-        fd.write(json.dumps(combined))
+    with (results.data_dir / "reproducible_results.json").open("wb") as fd:
+        fd.write(json_dumps(combined))
 
 
 def extract_reasons_from_tags(tags: t.Set[str]) -> dict:
-    reasons = {
-        "archive_metadata": False,
-        "packaging_tools": False,
-        "timestamps": False,
-        "permissions": False,
-        "unknown": False,
-        "distribution_metadata": False,
-        "distribution_description": False,
-        "distribution_headers": False
-    }
-
-    if "non-reproducibility:tooling" in tags:
-        reasons["packaging_tools"] = True
-
-    if "non-reproducibility:metadata:payload:normalization" in tags:
-        reasons["distribution_metadata"] = True
-        reasons["distribution_description"] = True
-
-    if "non-reproducibility:metadata:key-value" in tags:
-        reasons["distribution_metadata"] = True
-        reasons["distribution_headers"] = True
-
-    if "non-reproducibility:metadata" in tags:
-        reasons["archive_metadata"] = True
-
-    if "non-reproducibility:zip:timestamp" in tags:
-        reasons["timestamps"] = True
-
-    if "non-reproducibility:zip:external-attributes" in tags:
-        reasons["permissions"] = True
-
-    if "non-reproducibility:metadata:payload:unknown" in tags:
-        reasons["distribution_metadata"] = True
-
-    if "non-reproducibility:unknown" in tags:
-        reasons["unknown"] = True
+    mask = 0
+    for tag, tag_mask in _TAG_REASONS:
+        mask |= tag_mask * (tag in tags)
 
-    return reasons
+    return {reason: bool((mask >> idx) & 1) for idx, reason in enumerate(_REASONS)}
 
 
 def extract_tags(aura_diff: dict) -> t.Set[str]:
@@ -115,16 +114,17 @@ def extract_tags(aura_diff: dict) -> t.Set[str]:
 
     for detections in aura_diff["detections"]:
         for tag in detections["tags"]:
-            tags |= unwind_tag(tag)
+            tags.update(unwind_tag(tag))
 
     return tags
 
 
 def unwind_tag(tag) -> t.Set[str]:
     tags = set()
-    split_tag = tag.split(":")
+    prefix = None
 
-    for idx in range(1, len(split_tag)+1):
-        tags.add(":".join(split_tag[:idx]))
+    for part in tag.split(":"):
+        prefix = part if prefix is None else f"{prefix}:{part}"
+        tags.add(prefix)
 
     return tags
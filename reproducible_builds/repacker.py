@@ -1,21 +1,29 @@
 from __future__ import annotations
 
+import os
+import queue
+import threading
+import multiprocessing
+import shutil
 import hashlib
-import json
 import tempfile
 import logging
 import time
 from pathlib import Path
 from contextlib import nullcontext
-import traceback
 import typing as t
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future, as_completed, wait, FIRST_COMPLETED
 
 from . import docker_environment
 from . import common
 from . import postprocessing
 from .tools import aura_diff
+from .utils import json_dumps
 
 
+# How often a producer blocked on a full queue checks whether it should stop
+QUEUE_POLL_INTERVAL = 0.5
+
 logger = logging.getLogger(__name__)
 
 
@@ -30,10 +38,10 @@ def repack(package: common.Package, source_dir=None):
         if not sdist:
             raise FileNotFoundError("Could not found an appropriate sdist for rebuilding the package")
         logger.info(f"Found `{str(sdist)}` as source for repacking `{str(package)}")
-        cm = sdist.as_source()
+        cm = sdist.as_source(tmp_root=docker_environment.shared_source_root())
     elif package.package_type == common.PackageType.SDIST:
         logger.info(f"Using itself (sdist) to repack `{package}")
-        cm = package.as_source()
+        cm = package.as_source(tmp_root=docker_environment.shared_source_root())
     else:
         raise RuntimeError("Could not locate the source code for rebuilding the package")
 
@@ -50,82 +58,97 @@ def repack(package: common.Package, source_dir=None):
             logger.warning(f"Repacked package `{pkg_name}` already exists, skipping")
             return False
 
-        existing_files = set(x.name for x in repack_dir.iterdir() if x.is_file())
-
         if package.package_type == common.PackageType.SDIST:
             build_mode = "--sdist"
         else:
             build_mode = "--wheel"
 
-        logger.info("Spawning docker container")
+        norm_temp_cm = tempfile.TemporaryDirectory(prefix="normalized_reproducible_packages_")
+        # Processing of the original package does not depend on the build, it's overlapped with the docker run
+        with norm_temp_cm as norm_temp_dir, ThreadPoolExecutor(max_workers=4) as executor:
+            norm_temp_pth = Path(norm_temp_dir)
+            (norm_temp_pth/"original").mkdir(exist_ok=True)
+            (norm_temp_pth/"repacked").mkdir(exist_ok=True)
+            orig_archive_pth = norm_temp_pth / "original" / pkg_name
+            repacked_archive_pth = norm_temp_pth / "repacked" / pkg_name
 
-        stdout = repack_dir / "repack.stdout.txt"
-        stderr = repack_dir / "repack.stderr.txt"
+            original_checksum_f = executor.submit(_checksum, package.path)
+            logger.info(f"Normalizing original package `{pkg_name}`")
+            original_normalized_checksum_f = executor.submit(package.normalize, orig_archive_pth)
 
-        out_p = docker_environment.run_in_docker(
-            ["python", "-m", "build", build_mode, "--no-isolation", "--outdir", "/output_dir"],
-            docker_env=docker_env,
-            source_dir=src_path,
-            output_dir=repack_dir,
-            stdout=stdout, stderr=stderr
-        )
+            logger.info("Spawning docker container")
+            # Output of the build is identified by the modification time, no need to list the directory upfront
+            build_started = int(time.time())
 
-        new_files = set(x.name for x in repack_dir.iterdir() if x.is_file()) - existing_files
-        new_files -= {"repack.stdout.txt", "repack.stderr.txt"}
+            stdout = repack_dir / "repack.stdout.txt"
+            stderr = repack_dir / "repack.stderr.txt"
 
-        if out_p.returncode != 0:
-            logger.error(f"Failed to repack `{pkg_name}`, check repack.stderr.txt logs")
-            return False
+            out_p = docker_environment.run_in_docker(
+                ["python", "-m", "build", build_mode, "--no-isolation", "--outdir", docker_environment.OUTPUT_DIR],
+                docker_env=docker_env,
+                source_dir=src_path,
+                output_dir=repack_dir,
+                stdout=stdout, stderr=stderr
+            )
 
-        if pkg_name not in new_files:
-            logger.error(f"Unable to locate output file `{pkg_name}`, content: {', '.join(new_files)}")
-            return False
+            if out_p.returncode != 0:
+                logger.error(f"Failed to repack `{pkg_name}`, check repack.stderr.txt logs")
+                return False
 
+            if not new_package_pth.is_file():
+                new_files = _file_names(repack_dir, modified_since=build_started)
+                new_files -= {"repack.stdout.txt", "repack.stderr.txt"}
+                logger.error(f"Unable to locate output file `{pkg_name}`, content: {', '.join(new_files)}")
+                return False
 
-        new_pkg = common.Package.from_file(new_package_pth)
+            new_pkg = common.Package.from_file(new_package_pth)
 
-        common.run_diffoscope(original=package.path, target=new_package_pth)
-        aura_diff.run_aura_diff(original=package.path, target=new_package_pth)
+            repacked_checksum_f = executor.submit(_checksum, new_package_pth)
+            # Diffs of the raw packages are independent of the normalized ones, both are running at the same time
+            diffs = [executor.submit(common.run_diffoscope, original=package.path, target=new_package_pth)]
 
-        with tempfile.TemporaryDirectory(prefix="normalized_reproducible_packages_") as norm_temp_dir:
-            norm_temp_pth = Path(norm_temp_dir)
-            (norm_temp_pth/"original").mkdir(exist_ok=True)
-            (norm_temp_pth/"repacked").mkdir(exist_ok=True)
-            orig_archive_pth = norm_temp_pth / "original" / pkg_name
-            repacked_archive_pth = norm_temp_pth / "repacked" / pkg_name
-            logger.info(f"Normalizing original package `{pkg_name}`")
-            package.normalize(orig_archive_pth)
-            logger.info(f"Normalizing repacked package `{pkg_name}`")
-            new_pkg.normalize(repacked_archive_pth)
+            original_checksum = original_checksum_f.result()
+            repacked_checksum = repacked_checksum_f.result()
+            original_normalized_checksum = original_normalized_checksum_f.result()
 
-            original_normalized_md5 = hashlib.md5(orig_archive_pth.read_bytes()).hexdigest()
-            repacked_normalized_md5 = hashlib.md5(repacked_archive_pth.read_bytes()).hexdigest()
+            if original_checksum == repacked_checksum:
+                # Normalization is deterministic, identical archives would be just re-compressed into the same output
+                logger.info(f"Repacked package `{pkg_name}` is identical to the original, reusing the normalized archive")
+                shutil.copyfile(orig_archive_pth, repacked_archive_pth)
+                repacked_normalized_checksum = original_normalized_checksum
+            else:
+                logger.info(f"Normalizing repacked package `{pkg_name}`")
+                repacked_normalized_checksum = new_pkg.normalize(repacked_archive_pth)
 
             logger.info(f"Diffing normalized packages `{pkg_name}`")
+            # Aura diffs for both the raw and normalized packages are running concurrently
+            diffs.append(executor.submit(
+                aura_diff.run_aura_diffs_concurrently,
+                [
+                    (package.path, new_package_pth, ""),
+                    (orig_archive_pth, repacked_archive_pth, "_normalized"),
+                ],
+                target_path=repack_dir
+            ))
             common.run_diffoscope(
                 original=orig_archive_pth,
                 target=repacked_archive_pth,
                 out_dir=repack_dir,
                 suffix="_normalized",
             )
-            aura_diff.run_aura_diff(
-                original=orig_archive_pth,
-                target=repacked_archive_pth,
-                target_path=repack_dir,
-                suffix="_normalized"
-            )
 
-        original_md5 = hashlib.md5(package.path.read_bytes()).hexdigest()
-        repacked_md5 = hashlib.md5(new_package_pth.read_bytes()).hexdigest()
+            for diff_f in diffs:
+                diff_f.result()
 
         checksums = {
-            "original": original_md5,
-            "repacked": repacked_md5,
-            "normalized_original": original_normalized_md5,
-            "normalized_repacked": repacked_normalized_md5
+            "alg": common.CHECKSUM_ALGORITHM,
+            "original": original_checksum,
+            "repacked": repacked_checksum,
+            "normalized_original": original_normalized_checksum,
+            "normalized_repacked": repacked_normalized_checksum
         }
-        with (new_package_pth.parent / "checksums.json").open("w") as fd:
-            fd.write(json.dumps(checksums))
+        with (new_package_pth.parent / "checksums.json").open("wb") as fd:
+            fd.write(json_dumps(checksums))
 
     results = common.ReproducibleResults.from_package(package)
     postprocessing.combine_results(results)
@@ -135,20 +158,165 @@ def repack(package: common.Package, source_dir=None):
     return True
 
 
-def repack_all(dataset_dir: Path):
+def repack_all(dataset_dir: Path, jobs: t.Optional[int]=None, reuse_containers: bool=False):
+    if reuse_containers:
+        containers_cm = docker_environment.persistent_containers(output_root=dataset_dir)
+    else:
+        containers_cm = nullcontext()
+
+    with containers_cm as containers:
+        # Workers are spawned on demand while the prefetch thread is running, forking this (multi-threaded) process
+        # for them is not safe so they are started from the single-threaded forkserver instead
+        executor = ProcessPoolExecutor(
+            max_workers=jobs,
+            mp_context=multiprocessing.get_context("forkserver"),
+            initializer=docker_environment.use_persistent_containers,
+            initargs=(containers,)
+        )
+        max_running = 2 * (jobs or os.cpu_count() or 1)
+        pending: queue.Queue[t.Optional[common.Package]] = queue.Queue(maxsize=32)
+        stop = threading.Event()
+
+        def prefetch():
+            # Enumeration and the skip checks are overlapped with the repacking by running them in a separate thread
+            try:
+                for pkg in _pending_packages(dataset_dir):
+                    if not _put_unless_stopped(pending, pkg, stop):
+                        return
+            finally:
+                _put_unless_stopped(pending, None, stop)
+
+        with ThreadPoolExecutor(max_workers=1) as prefetch_executor, executor:
+            prefetcher = prefetch_executor.submit(prefetch)
+            running: t.Dict[Future, common.Package] = {}
+
+            try:
+                while (pkg := pending.get()) is not None:
+                    running[executor.submit(repack, pkg)] = pkg
+
+                    if len(running) >= max_running:
+                        done, _ = wait(running, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            _log_repack_result(future, running.pop(future))
+
+                for future in as_completed(running):
+                    _log_repack_result(future, running[future])
+            except BaseException:
+                # Unblock the prefetch thread and drop the repacks that did not start yet, otherwise exiting
+                # the executors would wait for both of them indefinitely
+                stop.set()
+                for future in running:
+                    future.cancel()
+                raise
+
+            prefetcher.result()
+
+
+def repack_pipeline(package_paths: t.Iterable[Path], jobs: t.Optional[int]=None):
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+
+    pending: queue.Queue[t.Optional[common.Package]] = queue.Queue(maxsize=8)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for pkg_path in package_paths:
+                if stop.is_set():
+                    return
+                elif not common.PackageType.detect(pkg_path.name):
+                    continue
+
+                pkg = common.Package.from_file(pkg_path)
+                if needs_repack(pkg):
+                    logger.info(f"Scheduling repack for package `{pkg.path.name}`")
+                    if not _put_unless_stopped(pending, pkg, stop):
+                        return
+        finally:
+            for _ in range(jobs):
+                if not _put_unless_stopped(pending, None, stop):
+                    break
+
+    def consume():
+        while not stop.is_set():
+            try:
+                pkg = pending.get(timeout=QUEUE_POLL_INTERVAL)
+            except queue.Empty:
+                continue
+
+            if pkg is None:
+                return
+            _repack_safe(pkg)
+
+    with ThreadPoolExecutor(max_workers=jobs+1) as executor:
+        producer = executor.submit(produce)
+        consumers = [executor.submit(consume) for _ in range(jobs)]
+
+        try:
+            producer.result()
+            for consumer in consumers:
+                consumer.result()
+        except BaseException:
+            # Tell both sides to finish their current package and exit, otherwise leaving the executor
+            # would wait for the whole remaining download/repack queue
+            stop.set()
+            raise
+
+
+def _put_unless_stopped(pending: queue.Queue, item, stop: threading.Event) -> bool:
+    # Blocking `put` that gives up once the consumers are gone (signaled via the `stop` event)
+    while True:
+        try:
+            pending.put(item, timeout=QUEUE_POLL_INTERVAL)
+            return True
+        except queue.Full:
+            if stop.is_set():
+                return False
+
+
+def _log_repack_result(future: Future, pkg: common.Package):
+    try:
+        repacked = future.result()
+    except Exception:
+        logger.exception(f"Repacking of package `{pkg.path.name}` failed")
+    else:
+        logger.info(f"Repacking of package `{pkg.path.name}` completed, repacked: {repacked}")
+
+
+def needs_repack(pkg: common.Package) -> bool:
+    # Skip if the repacked archive already exists
+    if (pkg.repack_dir / pkg.path.name).exists():
+        return False
+
+    if docker_environment.get_environment_version(pkg.path.name) is None:
+        logger.info(f"Unsupported package type: `{pkg.path.name}`, skipping repacking...")
+        return False
+
+    return True
+
+
+def _pending_packages(dataset_dir: Path) -> t.Iterator[common.Package]:
     for idx, pkg in enumerate(common.Package.enumerate(dataset_dir)):
-        repack_dir = pkg.repack_dir
-        # Skip if the repacked archive already exists
-        if (repack_dir / pkg.path.name).exists():
-            continue
+        if needs_repack(pkg):
+            logger.info(f"Scheduling repack for package `{pkg.path.name}` #{idx+1}")
+            yield pkg
 
-        docker_env = docker_environment.get_environment_version(pkg.path.name)
-        if docker_env is None:
-            logger.info(f"Unsupported package type: `{pkg.path.name}`, skipping repacking... #{idx+1}")
-            continue
 
-        logger.info(f"Starting repack for package `{pkg.path.name}` #{idx+1}")
-        try:
-            repack(pkg)
-        except Exception:
-            traceback.print_exc()
+def _repack_safe(pkg: common.Package) -> bool:
+    try:
+        return repack(pkg)
+    except Exception:
+        logger.exception(f"Repacking of package `{pkg.path.name}` failed")
+        return False
+
+
+def _file_names(location: Path, modified_since: float=0) -> t.Set[str]:
+    with os.scandir(location) as it:
+        return {
+            entry.name for entry in it
+            if entry.is_file(follow_symlinks=False) and entry.stat(follow_symlinks=False).st_mtime >= modified_since
+        }
+
+
+def _checksum(pth: Path) -> str:
+    return common.hash_file(pth, hashlib.new(common.CHECKSUM_ALGORITHM)).hexdigest()
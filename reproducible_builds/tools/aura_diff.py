@@ -1,55 +1,56 @@
-import sys
-import shutil
+import tempfile
 import subprocess
-from contextlib import nullcontext
 from pathlib import Path
 import typing as t
 
 
-from ..utils import with_tmp_dir
+from ..utils import link_or_copy
 
 
 # TODO: make this configurable
 AURA_DIFF_IMG = "sourcecodeai/ambience:base-69b5858-dirty"
 
 
-def run_aura_diff(
-        original: Path,
-        target: Path,
-        target_path: t.Optional[Path]=None,
-        stdout: t.Optional[Path]=None,
-        stderr: t.Optional[Path]=None,
-        suffix: str="",
-    ):
-    if target_path is None:
-        target_path = target.parent
-
-    diff_name = f"aura_diff{suffix}.json"
-
-    if stdout:
-        stdout_cm = stdout.open("w")
-    else:
-        stdout_cm = nullcontext(sys.stdout)
-
-    if stderr:
-        stderr_cm = stderr.open("w")
-    else:
-        stderr_cm = nullcontext(sys.stderr)
-
-    with with_tmp_dir(original, target) as temp_dir:
-        orig_path = f"/diff_data/original/{original.name}"
-        mod_path = f"/diff_data/modified/{target.name}"
-
-        cmd = [
-            "docker", "run", "--rm",
-            "-v", f"{str(temp_dir)}:/diff_data",
-            "-v", f"{target_path}:/output_data",
-            "-w", "/diff_data",
-            AURA_DIFF_IMG,
-            "diff",
-            orig_path, mod_path,
-            "-f", f"json:///output_data/{diff_name}"
-        ]
-
-        with stdout_cm as stdout_fd, stderr_cm as stderr_fd:
-            return subprocess.run(cmd, stdout=stdout_fd, stderr=stderr_fd)
+def run_aura_diffs_concurrently(
+        pairs: t.Sequence[t.Tuple[Path, Path, str]],
+        target_path: Path,
+    ) -> t.List[subprocess.CompletedProcess]:
+    # Diffs multiple (original, target, suffix) pairs, each one in its own container (running concurrently)
+    # with all of them sharing a single temporary directory with the packages
+    with tempfile.TemporaryDirectory(prefix="reproducible-builds-tmpdir-") as temp_dir:
+        procs = []
+
+        try:
+            for idx, (original, target, suffix) in enumerate(pairs):
+                pair_dir = Path(temp_dir) / str(idx)
+                (pair_dir / "original").mkdir(parents=True)
+                (pair_dir / "modified").mkdir()
+                link_or_copy(original, pair_dir / "original" / original.name)
+                link_or_copy(target, pair_dir / "modified" / target.name)
+
+                cmd = _aura_diff_cmd(
+                    diff_dir=temp_dir,
+                    orig_path=f"/diff_data/{idx}/original/{original.name}",
+                    mod_path=f"/diff_data/{idx}/modified/{target.name}",
+                    target_path=target_path,
+                    diff_name=f"aura_diff{suffix}.json"
+                )
+                procs.append(subprocess.Popen(cmd))
+        finally:
+            # Containers that were already started must finish before their temporary directory is removed
+            returncodes = [proc.wait() for proc in procs]
+
+        return [subprocess.CompletedProcess(proc.args, code) for proc, code in zip(procs, returncodes)]
+
+
+def _aura_diff_cmd(diff_dir, orig_path: str, mod_path: str, target_path: Path, diff_name: str) -> t.List[str]:
+    return [
+        "docker", "run", "--rm",
+        "-v", f"{str(diff_dir)}:/diff_data",
+        "-v", f"{target_path}:/output_data",
+        "-w", "/diff_data",
+        AURA_DIFF_IMG,
+        "diff",
+        orig_path, mod_path,
+        "-f", f"json:///output_data/{diff_name}"
+    ]
@@ -1,16 +1,23 @@
+import os
 import gzip
+import json
 import subprocess
 import shutil
 import logging
-import tempfile
-import contextlib
 from pathlib import Path
+import typing as t
 
 import requests
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 DEFAULT_OUTPUT_DIR = "reproducible_dataset"
 DOWNLOAD_STATS_URL = "https://cdn.sourcecode.ai/aura/pypi_download_stats.gz"
+COPY_BUFSIZE = 1 << 20
 
 logger = logging.getLogger(__name__)
 
@@ -20,14 +27,31 @@ def download_stats(pth: Path):
         pth /= "pypi_download_stats.json"
 
     logger.info(f"Downloading `{DOWNLOAD_STATS_URL}`")
-    resp = requests.get(DOWNLOAD_STATS_URL)
-    if resp.status_code != 200:
-        raise ValueError("Something went wrong when downloading the pypi download stats")
+    # Decompressed while downloading, written under a temporary name so an interrupted download is not left behind
+    partial_pth = pth.with_name(pth.name + ".part")
+    with requests.get(DOWNLOAD_STATS_URL, stream=True, timeout=30) as resp:
+        resp.raise_for_status()
+        resp.raw.decode_content = True
+
+        with gzip.GzipFile(fileobj=resp.raw, mode="rb") as gz_fd, partial_pth.open("wb") as out_fd:
+            shutil.copyfileobj(gz_fd, out_fd, COPY_BUFSIZE)
 
-    pth.write_bytes(gzip.decompress(resp.content))
+    os.replace(partial_pth, pth)
     logger.info(f"PyPI download stats written to `{str(pth)}`")
 
 
+def json_loads(data: t.Union[bytes, str]) -> t.Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(obj: t.Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode("utf-8")
+
+
 def check_command(bin: str, *args):
     location = shutil.which(bin)
     if not location:
@@ -41,15 +65,9 @@ def check_command(bin: str, *args):
     return True
 
 
-@contextlib.contextmanager
-def with_tmp_dir(original: Path, modified: Path) -> Path:
-    with tempfile.TemporaryDirectory(prefix="reproducible-builds-tmpdir-") as tdir:
-        tdir_pth = Path(tdir)
-        orig_dir = (tdir_pth / "original")
-        orig_dir.mkdir()
-        mod_dir = (tdir_pth / "modified")
-        mod_dir.mkdir()
-        (tdir_pth / "output").mkdir()
-        shutil.copy(original, (orig_dir/original.name))
-        shutil.copy(modified, (mod_dir/modified.name))
-        yield tdir
+def link_or_copy(src: Path, dest: Path):
+    # Hardlinks are possible only within the same filesystem, fallback to a full copy otherwise
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copy(src, dest)